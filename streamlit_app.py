@@ -4,16 +4,28 @@ import os
 import json
 import time
 import re
+import datetime
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
+from io import BytesIO
 from tempfile import NamedTemporaryFile
 
+import numpy as np
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Local PDF text layer
+from PyPDF2 import PdfReader, PdfWriter
+
 # Google auth & clients
+from google.api_core.exceptions import GoogleAPICallError, InvalidArgument, PreconditionFailed
 from google.oauth2 import service_account
 from google.cloud import storage
-from google.cloud import documentai_v1 as documentai
 
-# Vertex / Gemini
-import vertexai
-from vertexai.generative_models import GenerativeModel
+# Document AI and Vertex / Gemini SDKs are heavy to import; they are imported inside the
+# functions that use them so the first page render doesn't wait on them
 
 # -------------------------
 # Page config
@@ -31,6 +43,119 @@ LOCATION = APP_CONFIG.get("location", "us")                      # Document AI r
 VERTEX_LOCATION = APP_CONFIG.get("vertex_location", "us-central1")
 BUCKET_NAME = APP_CONFIG.get("bucket_name", "contract-risk-scanner-bucket-7119")
 PROCESSOR_ID = APP_CONFIG.get("processor_id", "e2f1e97f3572e66")
+DOCAI_API_ENDPOINT = f"{LOCATION}-documentai.googleapis.com"          # regional, not global
+VERTEX_API_ENDPOINT = f"{VERTEX_LOCATION}-aiplatform.googleapis.com"
+GRPC_CHANNEL_OPTIONS = [
+    ("grpc.keepalive_time_ms", 30000),        # keep the cached channel warm between requests
+    ("grpc.max_send_message_length", -1),     # unlimited, as the generated transport defaults
+    ("grpc.max_receive_message_length", -1),
+]
+MIN_TEXT_CHARS_PER_PAGE = 20  # below this a PDF is treated as scanned and sent to Document AI
+DOCAI_PAGES_PER_SHARD = 10   # large PDFs are split into page-range shards OCR'd in parallel
+DOCAI_MAX_WORKERS = 8         # in-flight online OCR requests per process (Document AI per-project QPS)
+DOCAI_BATCH_MIN_BYTES = 20 * 1024 * 1024  # online process_document request size ceiling
+DOCAI_BATCH_MIN_PAGES = DOCAI_PAGES_PER_SHARD * DOCAI_MAX_WORKERS  # more than one parallel wave
+DOCAI_BATCH_TIMEOUT = 600     # seconds
+BACKGROUND_MAX_WORKERS = 8
+GCS_RESUMABLE_MIN_BYTES = 5 * 1024 * 1024  # larger uploads go through a chunked resumable session
+GCS_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024   # must be a multiple of 256 KiB
+GEMINI_MODEL_NAME = "gemini-2.5-flash-lite"
+GEMINI_RESPONSE_CACHE_TTL = 86400  # seconds; local cache of Gemini output per contract slice
+GEMINI_RESPONSE_CACHE_MAX_ENTRIES = 128
+GEMINI_CONTEXT_CACHE_TTL = 3600    # seconds; Vertex context cache for the static instructions
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = 2048  # Vertex rejects smaller context caches
+GEMINI_INPUT_TOKEN_BUDGET = 6000   # contract tokens sent per analysis (replaces a fixed char cut)
+GEMINI_MAX_OUTPUT_TOKENS = 4096    # per contract: ~20 clauses of schema JSON including original_text
+GEMINI_MAX_DOCUMENTS_PER_CALL = 4  # contracts batched into one Gemini request
+EXTRACT_MAX_WORKERS = 4            # contracts OCR'd concurrently (each may shard further)
+EMBEDDING_MODEL_NAME = "text-embedding-004"
+EMBEDDING_BATCH_SIZE = 100          # texts per get_embeddings request
+SEGMENT_MIN_CHARS = 200             # shorter pieces are merged into the next segment
+SEGMENT_SIMILARITY_THRESHOLD = 0.98  # cosine similarity above which a prior segment analysis is reused
+SEGMENT_CACHE_MAX_ENTRIES = 500     # per session
+SUMMARY_MAX_ITEMS = 6               # matches the 3-6 actions the prompt asks for
+PROMPT_VERSION = "v8"  # bump when the analysis prompt changes to invalidate cached results
+
+# -------------------------
+# Analysis prompt (static part, sent once as a system instruction / context cache)
+# -------------------------
+STATIC_INSTRUCTIONS = """
+You are a legal contract analysis assistant. The user provides one or more contracts, each introduced by a "--- DOCUMENT k ---" line. Analyze each contract and return a SINGLE VALID JSON OBJECT with one top-level key, "documents": an array with one object per contract, each with three keys:
+
+1) "document_index": the k of the contract's "--- DOCUMENT k ---" line.
+
+2) "clauses": an array where each item is an object with these exact fields:
+   - clause_id (integer)
+   - original_text (string)
+   - simplified_text (string)
+   - risk_category (one of ["Termination","Compensation","Confidentiality","Liability","Non-compete","Data Sharing","Jurisdiction","Auto-Renewal","Penalty Fees","Unilateral Changes","Other"])
+   - severity (one of ["High","Medium","Low"])
+   - why_it_matters (string)
+   - actionable_recommendations (array of short strings, 1-3 items)
+   - segment_id (integer): the N of the "[Segment N]" marker the clause appears under
+
+3) "actionable_recommendations_summary": array of 3-6 short, prioritized actions for the entire contract.
+
+Important rules:
+- Respond ONLY with a single valid JSON object. No commentary, no markdown, no numbered prefixes.
+- Limit the clause extraction to concise chunks, up to 20 clauses per contract.
+- Keep each "simplified_text" to one sentence, and actionable recommendations to very short instructions.
+- Each contract's text is split into segments, each introduced by a "[Segment N]" line (N restarts per contract). Only analyze the segments given.
+"""
+
+# Per-request user turn: each contract's segments are appended to these constant heads
+DOCUMENT_DELIMITER = "--- DOCUMENT {} ---\n"
+PROMPT_HEAD = "Contract text:\n"
+PROMPT_HEAD_TRUNCATED = "Contract text (truncated):\n"
+
+# Structured output: Gemini returns JSON matching this schema, so parsing needs no repair
+RISK_CATEGORIES = [
+    "Termination", "Compensation", "Confidentiality", "Liability", "Non-compete", "Data Sharing",
+    "Jurisdiction", "Auto-Renewal", "Penalty Fees", "Unilateral Changes", "Other",
+]
+DOCUMENT_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "document_index": {"type": "integer"},
+        "clauses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "clause_id": {"type": "integer"},
+                    "original_text": {"type": "string"},
+                    "simplified_text": {"type": "string"},
+                    "risk_category": {"type": "string", "enum": RISK_CATEGORIES},
+                    "severity": {"type": "string", "enum": ["High", "Medium", "Low"]},
+                    "why_it_matters": {"type": "string"},
+                    "actionable_recommendations": {"type": "array", "items": {"type": "string"}},
+                    "segment_id": {"type": "integer"},
+                },
+                "required": [
+                    "clause_id", "original_text", "simplified_text", "risk_category",
+                    "severity", "why_it_matters", "actionable_recommendations", "segment_id",
+                ],
+            },
+        },
+        "actionable_recommendations_summary": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["document_index", "clauses", "actionable_recommendations_summary"],
+}
+ANALYSIS_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {"documents": {"type": "array", "items": DOCUMENT_ANALYSIS_SCHEMA}},
+    "required": ["documents"],
+}
+# kept as plain kwargs so this module needn't import vertexai; generate_analysis() wraps them in
+# GenerationConfig, whose schema conversion (e.g. "object" -> OBJECT) a raw dict would skip
+ANALYSIS_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": ANALYSIS_RESPONSE_SCHEMA,
+    "max_output_tokens": GEMINI_MAX_OUTPUT_TOKENS,  # bounds the tail on verbose contracts; scaled per batch
+    "temperature": 0.2,  # near-deterministic: same input -> same output, so the response cache holds
+    "top_p": 0.9,
+    "candidate_count": 1,
+}
 
 # -------------------------
 # Load credentials from Streamlit secrets
@@ -44,18 +169,51 @@ if "google_service_account" not in st.secrets:
 
 service_account_info = st.secrets["google_service_account"]
 
+@st.cache_resource(show_spinner=False)
+def get_credentials():
+    return service_account.Credentials.from_service_account_info(service_account_info)
+
 try:
-    credentials = service_account.Credentials.from_service_account_info(service_account_info)
+    credentials = get_credentials()
 except Exception as e:
     st.error(f"Failed to construct credentials from secrets: {e}")
     st.stop()
 
 # -------------------------
-# Initialize Google clients using credentials
+# Initialize Google clients using credentials (once per process, reused across reruns)
 # -------------------------
+@st.cache_resource(show_spinner=False)
+def get_storage_client():
+    return storage.Client(credentials=credentials, project=PROJECT_ID)
+
+@st.cache_resource(show_spinner=False)
+def get_docai_client():
+    from google.cloud import documentai_v1 as documentai
+    from google.cloud.documentai_v1.services.document_processor_service.transports import (
+        DocumentProcessorServiceGrpcTransport,
+    )
+
+    # regional endpoint matching the processor location, on a keepalive gRPC channel that is
+    # reused across calls (the client itself is cached per process)
+    channel = DocumentProcessorServiceGrpcTransport.create_channel(
+        f"{DOCAI_API_ENDPOINT}:443", credentials=credentials, options=GRPC_CHANNEL_OPTIONS
+    )
+    transport = DocumentProcessorServiceGrpcTransport(host=DOCAI_API_ENDPOINT, channel=channel)
+    return documentai.DocumentProcessorServiceClient(transport=transport)
+
+# Shared pool for background network work (uploads, Vertex init, cache writes) so the
+# script thread only blocks on results it actually needs
+@st.cache_resource(show_spinner=False)
+def get_background_executor():
+    return ThreadPoolExecutor(max_workers=BACKGROUND_MAX_WORKERS)
+
+# Process-wide bound on in-flight Document AI online requests (per-project QPS)
+@st.cache_resource(show_spinner=False)
+def get_docai_executor():
+    return ThreadPoolExecutor(max_workers=DOCAI_MAX_WORKERS)
+
 try:
-    storage_client = storage.Client(credentials=credentials, project=PROJECT_ID)
-    docai_client = documentai.DocumentProcessorServiceClient(credentials=credentials)
+    storage_client = get_storage_client()
 except Exception as e:
     st.error(f"Failed to initialize Google clients: {e}")
     st.stop()
@@ -63,6 +221,54 @@ except Exception as e:
 # -------------------------
 # Helper: sanitize and parse model output to JSON
 # -------------------------
+# numeric labels after "[", "{" or "," (e.g. `[0: {...}, 1: {...}]`), compiled once
+_NUMBERED_KEY_RE = re.compile(r'([\[\{,])\s*\d+\s*:')
+_JSON_START_RE = re.compile(r'[\[\{]')
+_JSON_DECODER = json.JSONDecoder()
+
+def _json_candidate_end(text: str, start: int):
+    """Return the index just past the bracket closing text[start], or len(text) if unclosed."""
+    depth, in_string, escaped = 0, False, False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in '[{':
+            depth += 1
+        elif ch in ']}':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return len(text)
+
+def first_json_value(text: str):
+    """Return the first top-level JSON object (else array) in text that decodes, or None."""
+    # positions nested inside a top-level candidate are never tried, so truncated output
+    # yields None rather than an inner fragment such as a single clause
+    starts, pos = [], 0
+    while True:
+        m = _JSON_START_RE.search(text, pos)
+        if m is None:
+            break
+        starts.append(m.start())
+        pos = _json_candidate_end(text, m.start())
+    for opener in '{[':
+        for start in starts:
+            if text[start] != opener:
+                continue
+            try:
+                return _JSON_DECODER.raw_decode(text, start)[0]
+            except json.JSONDecodeError:
+                continue
+    return None
+
 def sanitize_and_parse(analysis_raw: str):
     """Try parse JSON; attempt simple fixes if model output is malformed."""
     # direct parse
@@ -71,163 +277,578 @@ def sanitize_and_parse(analysis_raw: str):
     except Exception:
         pass
 
+    # skip prefix/suffix trivia (e.g. ```json fences) around an otherwise valid value
     text = analysis_raw.strip()
+    obj = first_json_value(text)
+    if obj is not None:
+        return obj
 
     # remove common numeric labels like 0:{ inside arrays
-    text = re.sub(r'(\[)\s*\d+\s*:', r'\1', text)
-    text = re.sub(r',\s*\d+\s*:', ',', text)
-    text = re.sub(r'\{\s*\d+\s*:', '{', text)
+    text = _NUMBERED_KEY_RE.sub(r'\1', text)
 
     # convert single quotes to double quotes only if it looks like JSON with single quotes
     if "'" in text and '"' not in text[:200]:
         text = text.replace("'", '"')
 
-    # extract first JSON object or array candidate
-    start_obj = text.find('{')
-    end_obj = text.rfind('}')
-    start_arr = text.find('[')
-    end_arr = text.rfind(']')
-
-    candidate = None
-    if start_obj != -1 and end_obj != -1 and end_obj > start_obj:
-        candidate = text[start_obj:end_obj+1]
-    elif start_arr != -1 and end_arr != -1 and end_arr > start_arr:
-        candidate = text[start_arr:end_arr+1]
-
-    if candidate:
-        try:
-            return json.loads(candidate)
-        except Exception:
-            pass
-
-    return None
+    return first_json_value(text)
 
 # Upload helper
-def upload_to_gcs_fileobj(file_obj, filename):
+def upload_to_gcs_bytes(pdf_bytes, pdf_hash, filename):
+    # blobs are named by content hash, so re-uploading the same PDF is a no-op
     bucket = storage_client.bucket(BUCKET_NAME)
-    ts = int(time.time())
-    safe_name = filename.replace(" ", "_")
-    blob_name = f"contracts/{ts}_{safe_name}"
+    blob_name = f"contracts/{pdf_hash}.pdf"
+    gcs_uri = f"gs://{BUCKET_NAME}/{blob_name}"
     blob = bucket.blob(blob_name)
-    file_obj.seek(0)
-    blob.upload_from_file(file_obj)
-    return f"gs://{BUCKET_NAME}/{blob_name}", blob_name
-# UI: file uploader
-st.header("Upload contract PDF")
-uploaded_pdf = st.file_uploader("📂 Upload Your Contract (PDF)", type=["pdf"])
+    if blob.exists():
+        return gcs_uri, blob_name
 
-if uploaded_pdf is None:
-    st.info("Upload a PDF for analysis.")
-    st.stop()
+    blob.content_type = "application/pdf"  # explicit type, no MIME sniffing
+    blob.metadata = {"filename": filename}
+    try:
+        # create-only: a concurrent upload of the same content wins the race harmlessly
+        if len(pdf_bytes) > GCS_RESUMABLE_MIN_BYTES:
+            # large files: chunked resumable upload, checksummed
+            blob.chunk_size = GCS_UPLOAD_CHUNK_SIZE
+            blob.upload_from_file(BytesIO(pdf_bytes), rewind=True, checksum="crc32c", if_generation_match=0)
+        else:
+            blob.upload_from_string(pdf_bytes, content_type="application/pdf", if_generation_match=0)
+    except PreconditionFailed:
+        pass
+    return gcs_uri, blob_name
+
+# Vertex context cache for the static instructions, created once per process per TTL window
+@st.cache_resource(ttl=GEMINI_CONTEXT_CACHE_TTL - 60, show_spinner=False)
+def get_instructions_cache():
+    """Return a CachedContent for STATIC_INSTRUCTIONS, or None if they're too small to cache."""
+    # ~4 chars/token: skip the request outright while the instructions can't meet the minimum
+    if len(STATIC_INSTRUCTIONS) // 4 < GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+        return None
+
+    from vertexai.preview import caching
 
-# Upload to GCS
-with st.spinner("⏳ Uploading contract to Google Cloud Storage..."):
     try:
-        gcs_uri, blob_name = upload_to_gcs_fileobj(uploaded_pdf, uploaded_pdf.name)
-        st.success("✅ File Uploaded")
-    except Exception as e:
-        st.error(f"Upload failed: {e}")
-        st.stop()
-# Document AI: extract text (direct)
-st.info("🔍 Extracting text from contract...")
-processor_name = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{PROCESSOR_ID}"
+        return caching.CachedContent.create(
+            model_name=GEMINI_MODEL_NAME,
+            system_instruction=STATIC_INSTRUCTIONS,
+            ttl=datetime.timedelta(seconds=GEMINI_CONTEXT_CACHE_TTL),
+        )
+    except InvalidArgument:
+        return None  # estimate was off and the content is still below the minimum
+
+# Vertex helper: init + model construction, once per process per context-cache TTL window
+# (first call runs in the background while OCR is in flight)
+@st.cache_resource(ttl=GEMINI_CONTEXT_CACHE_TTL - 60, show_spinner=False)
+def get_gemini_model():
+    import vertexai
+    from vertexai.preview.generative_models import GenerativeModel
+
+    # Vertex init: prefer passing credentials (and the regional endpoint) if supported,
+    # otherwise write temp key file
+    try:
+        try:
+            vertexai.init(
+                project=PROJECT_ID, location=VERTEX_LOCATION, api_endpoint=VERTEX_API_ENDPOINT, credentials=credentials
+            )
+        except TypeError:
+            # older SDKs without api_endpoint: keep in-memory credentials, default endpoint
+            vertexai.init(project=PROJECT_ID, location=VERTEX_LOCATION, credentials=credentials)
+    except TypeError:
+        # fallback: create a temp JSON key file and set env var (lives only in runtime)
+        tmpf = NamedTemporaryFile(delete=False, suffix=".json")
+        tmpf.write(json.dumps(service_account_info).encode("utf-8"))
+        tmpf.flush()
+        tmpf.close()
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = tmpf.name
+        vertexai.init(project=PROJECT_ID, location=VERTEX_LOCATION)
+
+    cached_instructions = get_instructions_cache()
+    if cached_instructions is not None:
+        return GenerativeModel.from_cached_content(cached_content=cached_instructions)
+    return GenerativeModel(GEMINI_MODEL_NAME, system_instruction=STATIC_INSTRUCTIONS)
+
+# Fast path: read the embedded text layer of digitally-generated PDFs locally
+def fast_text(pdf_bytes):
+    """Return (text, page_count) from the PDF text layer; ("", 0) if it can't be read."""
+    try:
+        reader = PdfReader(BytesIO(pdf_bytes))
+        # PyPDF2 pages carry no trailing newline; keep page breaks so lines/headings don't fuse
+        text = "\n\n".join((page.extract_text() or "") for page in reader.pages)
+        return text, len(reader.pages)
+    except Exception:
+        return "", 0
 
-try:
-    # download the uploaded object bytes back (or use uploaded_pdf.getvalue())
-    bucket = storage_client.bucket(BUCKET_NAME)
-    blob = bucket.blob(blob_name)
-    pdf_bytes = blob.download_as_bytes()
+# Split a PDF into in-memory page-range shards (whole PDF if it can't be parsed or is small)
+def split_pdf(pdf_bytes, page_count, pages_per_shard):
+    if page_count <= pages_per_shard:
+        return [pdf_bytes]
+    try:
+        reader = PdfReader(BytesIO(pdf_bytes))
+        shards = []
+        for start in range(0, page_count, pages_per_shard):
+            writer = PdfWriter()
+            for page in reader.pages[start:start + pages_per_shard]:
+                writer.add_page(page)
+            buf = BytesIO()
+            writer.write(buf)
+            shards.append(buf.getvalue())
+        return shards
+    except Exception:
+        return [pdf_bytes]
+
+# Document AI: OCR one PDF (or shard) and return its text
+def docai_process(pdf_bytes):
+    from google.cloud import documentai_v1 as documentai
 
+    processor_name = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{PROCESSOR_ID}"
     raw_document = documentai.RawDocument(content=pdf_bytes, mime_type="application/pdf")
     request = documentai.ProcessRequest(name=processor_name, raw_document=raw_document)
-    result = docai_client.process_document(request)
+    result = get_docai_client().process_document(request)
 
     if not (result and getattr(result, "document", None)):
-        st.error("Document AI returned no document object.")
-        st.stop()
+        raise RuntimeError("Document AI returned no document object.")
+    return result.document.text or ""
+
+# Document AI: OCR shards concurrently, returning texts in page order
+def docai_process_shards(shards):
+    # every process_document call goes through the shared pool, so concurrent contracts and
+    # sessions together stay within DOCAI_MAX_WORKERS in-flight requests
+    return list(get_docai_executor().map(docai_process, shards))  # map preserves page order
+
+# Document AI: batch-process a PDF already in GCS (large files) and merge shard texts in order
+def docai_batch_process(gcs_uri, blob_name):
+    from google.cloud import documentai_v1 as documentai
+
+    processor_name = f"projects/{PROJECT_ID}/locations/{LOCATION}/processors/{PROCESSOR_ID}"
+    output_prefix = f"docai_out/{blob_name}/"
+    request = documentai.BatchProcessRequest(
+        name=processor_name,
+        input_documents=documentai.BatchDocumentsInputConfig(
+            gcs_documents=documentai.GcsDocuments(
+                documents=[documentai.GcsDocument(gcs_uri=gcs_uri, mime_type="application/pdf")]
+            )
+        ),
+        document_output_config=documentai.DocumentOutputConfig(
+            gcs_output_config=documentai.DocumentOutputConfig.GcsOutputConfig(
+                gcs_uri=f"gs://{BUCKET_NAME}/{output_prefix}"
+            )
+        ),
+    )
+    operation = get_docai_client().batch_process_documents(request)
+    operation.result(timeout=DOCAI_BATCH_TIMEOUT)
+
+    # output lands under <prefix>/<operation id>/; blob names are stable, so scope to this run
+    operation_id = operation.operation.name.split("/")[-1]
+    output_prefix = f"{output_prefix}{operation_id}/"
+
+    documents = []
+    for blob in storage_client.list_blobs(BUCKET_NAME, prefix=output_prefix):
+        if blob.name.endswith(".json"):
+            documents.append(
+                documentai.Document.from_json(blob.download_as_bytes(), ignore_unknown_fields=True)
+            )
+    if not documents:
+        raise RuntimeError("Document AI batch processing produced no output documents.")
+
+    documents.sort(key=lambda doc: doc.shard_info.shard_index)
+    return "\n".join(doc.text or "" for doc in documents)
+
+# Extraction helper: cached by PDF content hash (in-process, then GCS "cache/" prefix)
+@st.cache_data(show_spinner=False, max_entries=128)
+def extract_text(pdf_hash, _pdf_bytes, _upload_future):
+    """Return contract text for the PDF; repeat uploads of the same bytes skip OCR."""
+    # two-tier: use the local text layer when present, Document AI only for scanned PDFs
+    text, page_count = fast_text(_pdf_bytes)
+    text = text.strip()
+    if page_count and len(text) > MIN_TEXT_CHARS_PER_PAGE * page_count:
+        return text
 
-    extracted_text = (result.document.text or "").strip()
-    if not extracted_text:
-        st.error("Document AI extracted no text. Try another file or configure a different processor.")
-        st.stop()
+    bucket = storage_client.bucket(BUCKET_NAME)
+    cache_blob = bucket.blob(f"cache/{pdf_hash}.txt")
+    try:
+        return cache_blob.download_as_text()  # one round-trip instead of exists() + download
+    except GoogleAPICallError:
+        pass  # best-effort, like the write: NotFound, Forbidden or transient errors are a miss
+
+    if len(_pdf_bytes) > DOCAI_BATCH_MIN_BYTES or page_count > DOCAI_BATCH_MIN_PAGES:
+        # too big for the online path: wait for the GCS upload and let Document AI batch it
+        gcs_uri, blob_name = _upload_future.result()
+        texts = [docai_batch_process(gcs_uri, blob_name)]
+    else:
+        shards = split_pdf(_pdf_bytes, page_count, DOCAI_PAGES_PER_SHARD)
+        texts = docai_process_shards(shards)
+
+    extracted_text = "\n".join(texts).strip()
+    if extracted_text:
+        # best-effort cache write off the script thread; failures only cost a future OCR run
+        get_background_executor().submit(
+            cache_blob.upload_from_string, extracted_text, content_type="text/plain"
+        )
+    return extracted_text
+
+# Tokens count_tokens adds on top of the contract text (system instruction, prompt head)
+@st.cache_data(show_spinner=False)
+def count_prompt_overhead(_model, prompt_version):
+    return _model.count_tokens(PROMPT_HEAD).total_tokens
+
+# Slice contract text to a token budget using the Gemini tokenizer (cached: count_tokens is an RPC)
+@st.cache_data(show_spinner=False, max_entries=128)
+def slice_to_token_budget(_model, text, budget):
+    """Return the longest whitespace-aligned prefix of text that fits in budget tokens."""
+    if len(text) <= budget:
+        return text  # a token always covers at least one character
+    overhead = count_prompt_overhead(_model, PROMPT_VERSION)
+
+    def contract_tokens(cut):
+        return _model.count_tokens(text[:cut]).total_tokens - overhead
+
+    def whitespace_aligned(cut):
+        boundary = text.rfind(" ", 0, cut)
+        return boundary if boundary > cut // 2 else cut
+
+    cut = len(text)
+    total = contract_tokens(cut)
+    for _ in range(3):  # rescale by the observed chars/token ratio; converges in 1-2 steps
+        if total <= budget:
+            break
+        cut = whitespace_aligned(int(cut * budget / total * 0.98))
+        total = contract_tokens(cut)
+    while total > budget:  # guaranteed fit if rescaling didn't converge
+        cut = whitespace_aligned(cut // 2)
+        total = contract_tokens(cut) if cut else 0
+    return text[:cut]
 
-    # write extracted text to a file for optional download (not displayed)
-    with open("extracted_contract_text.txt", "w", encoding="utf-8") as f:
-        f.write(extracted_text)
+# -------------------------
+# Segment reuse: only send clauses that changed since the last run in this session
+# -------------------------
+# clause-like boundaries: blank lines, or numbered headings ("1.", "2.3)", "Section 4", "ARTICLE V")
+_SEGMENT_SPLIT_RE = re.compile(
+    r'\n\s*\n|\n(?=\s*(?:\d+(?:\.\d+)*[.)]|Section\s+\d+|Article\s+[\dIVXLC]+)\s)', re.IGNORECASE
+)
+
+def split_segments(text):
+    """Split contract text into clause-like segments of at least SEGMENT_MIN_CHARS."""
+    segments, buf = [], ""
+    for part in _SEGMENT_SPLIT_RE.split(text):
+        part = part.strip()
+        if not part:
+            continue
+        buf = f"{buf}\n{part}" if buf else part
+        if len(buf) >= SEGMENT_MIN_CHARS:
+            segments.append(buf)
+            buf = ""
+    if buf:
+        if segments:
+            segments[-1] += "\n" + buf
+        else:
+            segments.append(buf)
+    return segments
+
+def segment_hash(segment):
+    return hashlib.blake2b(segment.encode("utf-8"), digest_size=16).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def get_embedding_model():
+    # vertexai.init has already run in get_gemini_model()
+    from vertexai.language_models import TextEmbeddingModel
+    return TextEmbeddingModel.from_pretrained(EMBEDDING_MODEL_NAME)
+
+def embed_segments(segments):
+    """Return unit-normalized embeddings, one row per segment, batched per request."""
+    model = get_embedding_model()
+    vectors = []
+    for i in range(0, len(segments), EMBEDDING_BATCH_SIZE):
+        vectors.extend(e.values for e in model.get_embeddings(segments[i:i + EMBEDDING_BATCH_SIZE]))
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def match_cached_segments(segments, segment_cache):
+    """Return ({segment index: cached entry}, [(changed segment index, embedding or None)])."""
+    hashes = [segment_hash(seg) for seg in segments]
+    reused = {i: segment_cache[h] for i, h in enumerate(hashes) if h in segment_cache}
+    changed = [i for i in range(len(segments)) if i not in reused]
+    if not changed:
+        return reused, []
 
-    st.success("🎯 Text extraction completed successfully. Ready for risk analysis phase.")
-    st.download_button("📥 Download Extracted Text (optional)", extracted_text, file_name="extracted_contract_text.txt")
+    try:
+        vectors = embed_segments([segments[i] for i in changed])
+    except Exception:
+        return reused, [(i, None) for i in changed]  # no embeddings: analyze everything not reused
+
+    cached = [entry for entry in segment_cache.values() if entry["embedding"] is not None]
+    if not cached:
+        return reused, list(zip(changed, vectors))
+
+    similarity = vectors @ np.stack([entry["embedding"] for entry in cached]).T
+    best = similarity.argmax(axis=1)
+    still_changed = []
+    for row, i in enumerate(changed):
+        if similarity[row, best[row]] >= SEGMENT_SIMILARITY_THRESHOLD:
+            reused[i] = cached[best[row]]
+        else:
+            still_changed.append((i, vectors[row]))
+    return reused, still_changed
+
+def store_segment_analyses(segment_cache, segments, changed, clauses, summary):
+    """Record Gemini's clauses for each newly analyzed segment (empty list = nothing risky)."""
+    for i, embedding in changed:
+        segment_cache[segment_hash(segments[i])] = {
+            "embedding": embedding,
+            "clauses": [c for c in clauses if c.get("segment_id") == i + 1],
+            "summary": summary,  # contract-level summary of the run that analyzed this segment
+        }
+    while len(segment_cache) > SEGMENT_CACHE_MAX_ENTRIES:
+        segment_cache.pop(next(iter(segment_cache)))  # oldest first (insertion order)
+
+def combine_summaries(summary, reused):
+    """Merge a partial run's summary with those stored for reused segments, deduplicated and capped."""
+    sources = [summary or []]
+    for entry in reused.values():
+        stored = entry.get("summary") or []
+        if stored not in sources:
+            sources.append(stored)
+    combined = []
+    for row in zip_longest(*sources):  # interleave so both changed and unchanged parts are represented
+        for item in row:
+            if item and item not in combined:
+                combined.append(item)
+    return combined[:SUMMARY_MAX_ITEMS]
+
+def merge_segment_clauses(segments, reused, clauses):
+    """Combine reused and fresh clauses in document order with sequential clause_ids."""
+    fresh = {}
+    for clause in clauses:
+        fresh.setdefault(clause.get("segment_id"), []).append(clause)
+    merged = []
+    for i in range(len(segments)):
+        clauses_i = reused[i]["clauses"] if i in reused else fresh.get(i + 1, [])
+        for clause in clauses_i:
+            merged.append({**clause, "segment_id": i + 1, "clause_id": len(merged) + 1})
+    return merged
+
+# Gemini response cache: process-wide {prompt_key: (timestamp, analysis_raw)}, keyed by
+# hash of (prompt + prompt version). Kept outside st.cache_data because the call
+# streams into a placeholder created by the caller, which cached-effect replay can't handle.
+# Shared by every session's script thread, so all access goes through the lock.
+@st.cache_resource(show_spinner=False)
+def get_analysis_cache():
+    return threading.Lock(), OrderedDict()
+
+def cached_analysis(prompt_key):
+    lock, cache = get_analysis_cache()
+    with lock:
+        entry = cache.get(prompt_key)
+    if entry and time.time() - entry[0] < GEMINI_RESPONSE_CACHE_TTL:
+        return entry[1]
+    return None
 
-except Exception as e:
-    st.error(f"Document AI processing failed: {e}")
+def store_analysis(prompt_key, analysis_raw):
+    """Cache a response; callers only store output they have parsed and validated."""
+    lock, cache = get_analysis_cache()
+    with lock:
+        cache.pop(prompt_key, None)
+        cache[prompt_key] = (time.time(), analysis_raw)  # insertion order == age
+        while len(cache) > GEMINI_RESPONSE_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)  # evict oldest
+
+# Gemini helper: stream the response into a placeholder so tokens show as they arrive
+def generate_analysis(prompt_key, model, prompt, placeholder, generation_config):
+    """Return (raw Gemini output, cache hit?), served from cache when the same prompt_key was seen."""
+    from vertexai.preview.generative_models import GenerationConfig
+
+    analysis_raw = cached_analysis(prompt_key)
+    if analysis_raw is not None:
+        return analysis_raw, True
+
+    parts = []
+    config = GenerationConfig(**generation_config)
+    for chunk in model.generate_content(prompt, generation_config=config, stream=True):
+        # finish-reason-only, blocked or MAX_TOKENS chunks carry no parts; chunk.text raises on them
+        if not (chunk.candidates and chunk.candidates[0].content.parts):
+            continue
+        parts.append(chunk.text)
+        placeholder.text("".join(parts)[-2000:])
+    placeholder.empty()
+
+    return "".join(parts).strip(), False
+
+# Run fn on a worker thread attached to the current script run, so cached functions
+# called there behave as they do on the script thread
+def run_in_script_ctx(ctx, fn, *args):
+    add_script_run_ctx(threading.current_thread(), ctx)
+    return fn(*args)
+
+# Show Gemini output that couldn't be used, with a TXT download
+def show_raw_output(message, analysis_raw, key):
+    st.warning(message)
+    st.text_area("Raw Gemini Output", analysis_raw, height=400, key=f"raw_{key}")
+    st.download_button(
+        "📥 Download Raw Analysis (TXT)", analysis_raw,
+        file_name="contract_risk_analysis.txt", key=f"raw_dl_{key}",
+    )
+
+# Build one batched prompt from (document, changed segments) pairs; k is the position in the call
+def build_batch_prompt(batch):
+    blocks = []
+    for k, (doc, changed) in enumerate(batch, start=1):
+        head = PROMPT_HEAD_TRUNCATED if doc["truncated"] else PROMPT_HEAD
+        body = "\n\n".join(f"[Segment {i + 1}]\n{doc['segments'][i]}" for i, _ in changed)
+        blocks.append(DOCUMENT_DELIMITER.format(k) + head + body)
+    return "\n\n".join(blocks)
+
+# UI: file uploader
+st.header("Upload contract PDFs")
+uploaded_pdfs = st.file_uploader("📂 Upload Your Contracts (PDF)", type=["pdf"], accept_multiple_files=True)
+
+if not uploaded_pdfs:
+    st.info("Upload one or more PDFs for analysis.")
     st.stop()
+
+# Upload to GCS and init Vertex in the background; OCR runs on the in-memory bytes meanwhile
+documents = {}
+for uploaded_pdf in uploaded_pdfs:
+    pdf_bytes = uploaded_pdf.getvalue()
+    pdf_hash = hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+    documents.setdefault(pdf_hash, {"name": uploaded_pdf.name, "bytes": pdf_bytes, "hash": pdf_hash})
+documents = list(documents.values())  # identical uploads are analyzed once
+
+executor = get_background_executor()
+model_future = executor.submit(get_gemini_model)
+for doc in documents:
+    doc["upload_future"] = executor.submit(upload_to_gcs_bytes, doc["bytes"], doc["hash"], doc["name"])
+
+# Document AI: extract text, several contracts concurrently
+st.info("🔍 Extracting text from contracts...")
+
+script_ctx = get_script_run_ctx()
+with ThreadPoolExecutor(max_workers=min(len(documents), EXTRACT_MAX_WORKERS)) as pool:
+    for doc in documents:
+        doc["text_future"] = pool.submit(
+            run_in_script_ctx, script_ctx, extract_text, doc["hash"], doc["bytes"], doc["upload_future"]
+        )
+
+extracted = []
+for doc in documents:
+    try:
+        doc["text"] = doc["text_future"].result()
+    except Exception as e:
+        st.error(f"Document AI processing failed for {doc['name']}: {e}")
+        continue
+    if not doc["text"]:
+        st.error(f"Document AI extracted no text from {doc['name']}. Try another file or configure a different processor.")
+        continue
+
+    # served from memory; no per-session file on the shared host disk
+    st.download_button(
+        f"📥 Download Extracted Text: {doc['name']} (optional)",
+        doc["text"],
+        file_name=f"{os.path.splitext(doc['name'])[0]}_extracted_text.txt",
+        key=f"text_{doc['hash']}",
+    )
+    extracted.append(doc)
+
+if not extracted:
+    st.stop()
+st.success("🎯 Text extraction completed successfully. Ready for risk analysis phase.")
+
+# GCS copy is archival only: report its status without blocking the analysis on it
+for doc in extracted:
+    upload_future = doc["upload_future"]
+    if not upload_future.done():
+        st.info(f"⏳ Archiving {doc['name']} to Google Cloud Storage in the background...")
+    elif upload_future.exception() is not None:
+        st.warning(f"Upload of {doc['name']} to Google Cloud Storage failed: {upload_future.exception()}")
+    else:
+        st.success(f"✅ File Uploaded: {doc['name']}")
+
 # Gemini (Vertex) analysis
 st.header("AI Risk Analysis")
 if st.button("🤖 Run Contract Risk Analysis"):
-    with st.spinner("Analyzing contract..."):
+    with st.spinner("Analyzing contracts..."):
         try:
-            # Vertex init: prefer passing credentials if supported, otherwise write temp key file
-            try:
-                vertexai.init(project=PROJECT_ID, location=VERTEX_LOCATION, credentials=credentials)
-            except TypeError:
-                # fallback: create a temp JSON key file and set env var (lives only in runtime)
-                tmpf = NamedTemporaryFile(delete=False, suffix=".json")
-                tmpf.write(json.dumps(service_account_info).encode("utf-8"))
-                tmpf.flush()
-                tmpf.close()
-                os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = tmpf.name
-                vertexai.init(project=PROJECT_ID, location=VERTEX_LOCATION)
-
-            model = GenerativeModel("gemini-2.5-flash-lite")
-
-            prompt = f"""
-You are a legal contract analysis assistant. Analyze the contract text below and return a SINGLE VALID JSON OBJECT with two top-level keys:
-
-1) "clauses": an array where each item is an object with these exact fields:
-   - clause_id (integer)
-   - original_text (string)
-   - simplified_text (string)
-   - risk_category (one of ["Termination","Compensation","Confidentiality","Liability","Non-compete","Data Sharing","Jurisdiction","Auto-Renewal","Penalty Fees","Unilateral Changes","Other"])
-   - severity (one of ["High","Medium","Low"])
-   - why_it_matters (string)
-   - actionable_recommendations (array of short strings, 1-3 items)
-
-2) "actionable_recommendations_summary": array of 3-6 short, prioritized actions for the entire contract.
-
-Important rules:
-- Respond ONLY with a single valid JSON object. No commentary, no markdown, no numbered prefixes.
-- Limit the clause extraction to concise chunks, up to 20 clauses.
-- Keep each "simplified_text" to one sentence, and actionable recommendations to very short instructions.
-
-Contract text (first 5000 characters):
-{extracted_text[:5000]}
-"""
-            response = model.generate_content(prompt)
-            analysis_raw = response.text.strip()
-
-            # attempt to parse JSON; sanitize if necessary
-            analysis_obj = sanitize_and_parse(analysis_raw)
-
-            if analysis_obj is None:
-                st.warning("⚠️ Gemini output could not be parsed as JSON. Showing raw output and providing TXT download.")
-                st.text_area("Raw Gemini Output", analysis_raw, height=400)
-                with open("contract_risk_analysis.txt", "w", encoding="utf-8") as f:
-                    f.write(analysis_raw)
-                st.download_button("📥 Download Raw Analysis (TXT)", analysis_raw, file_name="contract_risk_analysis.txt")
-            else:
+            model = model_future.result()
+
+            # reuse analyses of segments unchanged (or nearly so) since the last run in this session
+            segment_cache = st.session_state.setdefault("segment_cache", {})
+            pending = []
+            for doc in extracted:
+                contract_slice = slice_to_token_budget(model, doc["text"], GEMINI_INPUT_TOKEN_BUDGET)
+                doc["truncated"] = len(contract_slice) < len(doc["text"])
+                doc["segments"] = split_segments(contract_slice)
+                doc["reused"], changed = match_cached_segments(doc["segments"], segment_cache)
+                doc["clauses"], doc["summary"], doc["failed"] = [], None, False
+                if changed:
+                    pending.append((doc, changed))
+
+            # batch contracts with changed segments into as few Gemini calls as possible
+            for start in range(0, len(pending), GEMINI_MAX_DOCUMENTS_PER_CALL):
+                batch = pending[start:start + GEMINI_MAX_DOCUMENTS_PER_CALL]
+                prompt = build_batch_prompt(batch)
+                generation_config = {
+                    **ANALYSIS_GENERATION_CONFIG,
+                    "max_output_tokens": GEMINI_MAX_OUTPUT_TOKENS * len(batch),
+                }
+                prompt_key = hashlib.sha256((prompt + PROMPT_VERSION).encode("utf-8")).hexdigest()
+                analysis_raw, cache_hit = generate_analysis(prompt_key, model, prompt, st.empty(), generation_config)
+
+                # structured output parses directly; sanitize only if the response was cut short
+                analysis_obj = sanitize_and_parse(analysis_raw)
+                documents_out = analysis_obj.get("documents") if isinstance(analysis_obj, dict) else None
+                if not isinstance(documents_out, list):
+                    show_raw_output(
+                        "⚠️ Gemini output could not be parsed as JSON. Showing raw output and providing TXT download.",
+                        analysis_raw, prompt_key,
+                    )
+                    for doc, _ in batch:
+                        doc["failed"] = True
+                    continue
+
+                results = {r.get("document_index"): r for r in documents_out if isinstance(r, dict)}
+                missing = [doc for k, (doc, _) in enumerate(batch, start=1) if k not in results]
+                if missing:
+                    # e.g. a response cut off at max_output_tokens: report it, don't show empty results
+                    names = ", ".join(doc["name"] for doc in missing)
+                    show_raw_output(
+                        f"⚠️ Gemini output has no analysis for: {names}. Showing raw output and providing TXT download.",
+                        analysis_raw, prompt_key,
+                    )
+                    for doc in missing:
+                        doc["failed"] = True
+                elif not cache_hit:
+                    # only complete, parseable output is cached; hits keep their original timestamp
+                    store_analysis(prompt_key, analysis_raw)
+
+                for k, (doc, changed) in enumerate(batch, start=1):
+                    result = results.get(k)
+                    if result is None:
+                        continue  # failed above; don't cache its segments as clean
+                    doc["clauses"] = [c for c in result.get("clauses") or [] if isinstance(c, dict)]
+                    doc["summary"] = result.get("actionable_recommendations_summary")
+                    if doc["reused"]:
+                        # Gemini only saw the changed segments; keep the rest of the contract's summary
+                        doc["summary"] = combine_summaries(doc["summary"], doc["reused"])
+                    store_segment_analyses(segment_cache, doc["segments"], changed, doc["clauses"], doc["summary"])
+
+            for doc in extracted:
+                if doc["failed"]:
+                    continue
+                analysis_obj = {
+                    "clauses": merge_segment_clauses(doc["segments"], doc["reused"], doc["clauses"]),
+                    # fully reused contracts take the summary stored with their segments
+                    "actionable_recommendations_summary": doc["summary"] or next(
+                        (entry["summary"] for entry in doc["reused"].values() if entry.get("summary")), []
+                    ),
+                }
                 pretty_json = json.dumps(analysis_obj, indent=2, ensure_ascii=False)
-                with open("contract_risk_analysis.json", "w", encoding="utf-8") as f:
-                    f.write(pretty_json)
-
-                st.success("✅ Legal Risk Analysis Completed")
-                st.subheader("📋 Clause-level Analysis (JSON)")
+                st.success(f"✅ Legal Risk Analysis Completed: {doc['name']}")
+                st.subheader(f"📋 Clause-level Analysis (JSON): {doc['name']}")
                 st.json(analysis_obj)
 
                 st.download_button(
                     label="📥 Download Risk Analysis (JSON)",
                     data=pretty_json,
-                    file_name="contract_risk_analysis.json",
-                    mime="application/json"
+                    file_name=f"{os.path.splitext(doc['name'])[0]}_risk_analysis.json",
+                    mime="application/json",
+                    key=f"analysis_{doc['hash']}",
                 )
 
                 # show high-level actionable summary if present